@@ -4,6 +4,9 @@ re_get_gerrit = re.compile(r"gerrit=(?P<gerrit_id>\d+)", re.IGNORECASE)
 re_get_status = re.compile(r"status=(?P<status>.*?)(}}|\|)", re.IGNORECASE)
 re_get_title = re.compile(r"title=(?P<title>.*?)(}}|\|)", re.IGNORECASE)
 re_get_type = re.compile(r"type=(?P<type>.*?)(}}|\|)", re.IGNORECASE)
+re_get_heading = re.compile(
+    r"^(?P<level>={2,6})\s*(?P<heading>.+?)\s*(?P=level)\s*$", re.MULTILINE
+)
 
 
 class Deployment:
@@ -55,3 +58,59 @@ class Deployment:
             return match.group("type")
         else:
             return None
+
+
+def get_section_path(page_content: str, offset: int) -> tuple[str, ...]:
+    """Get the headings of the section (and its parents) containing an offset"""
+    path: list[tuple[int, str]] = []
+    for match in re_get_heading.finditer(page_content, 0, offset):
+        level = len(match.group("level"))
+        path = [(lvl, heading) for lvl, heading in path if lvl < level]
+        path.append((level, match.group("heading")))
+    return tuple(heading for _, heading in path)
+
+
+def find_section_span(
+    page_content: str, section_path: tuple[str, ...]
+) -> None | tuple[int, int]:
+    """Find the start and end offsets of a section by its heading path"""
+    if len(section_path) == 0:
+        first_heading = re_get_heading.search(page_content)
+        return 0, first_heading.start() if first_heading else len(page_content)
+    path: list[tuple[int, str]] = []
+    start = None
+    section_level = 0
+    for match in re_get_heading.finditer(page_content):
+        level = len(match.group("level"))
+        if start is not None and level <= section_level:
+            return start, match.start()
+        path = [(lvl, heading) for lvl, heading in path if lvl < level]
+        path.append((level, match.group("heading")))
+        if start is None and tuple(heading for _, heading in path) == section_path:
+            start = match.end()
+            section_level = level
+    if start is not None:
+        return start, len(page_content)
+    return None
+
+
+class PlannedChange:
+    def __init__(self, section_path: tuple[str, ...], old: str, new: str):
+        self.section_path = section_path
+        self.old = old
+        self.new = new
+
+    def apply(self, page_content: str) -> None | str:
+        """Apply this change to a page, or return None if it no longer applies"""
+        span = find_section_span(page_content, self.section_path)
+        if span is None:
+            return None
+        start, end = span
+        section_content = page_content[start:end]
+        if self.old not in section_content:
+            return None
+        return (
+            page_content[:start]
+            + section_content.replace(self.old, self.new)
+            + page_content[end:]
+        )
@@ -5,3 +5,9 @@ VERSION_STRING = f"{DESCRIPTION}\nv{__version__} ({SOURCE})"
 WIKITECH_WIKI = "wikitech.wikimedia.org"
 GERRIT_URL = "gerrit.wikimedia.org"
 SAL_URL = "sal.toolforge.org"
+EDIT_ATTEMPTS = 3
+LOOKUP_WORKERS = 8
+CIRCUIT_BREAKER_THRESHOLD = 5
+RETRY_QUEUE_SIZE = 20
+RETRY_ATTEMPTS = 2
+FAILED_IDS_FILE = "logs/failed_gerrit_ids.json"
@@ -5,17 +5,31 @@ import constants
 import datetime
 import json
 import logging
+import queue
 import random
 import re
 import requests
+import socket
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from pwiki.wiki import Wiki  # type: ignore
 from requests.adapters import HTTPAdapter
+from typing import Callable, Iterator
 from urllib3 import Retry
 
-args = argparse.Namespace(dry=False, verbose=False)
+args = argparse.Namespace(
+    dry=False,
+    verbose=False,
+    log_to_wiki=False,
+    limit=60,
+    time_budget=None,
+    events=None,
+    retry_failed=False,
+    duplicates="all",
+)
 log = logging.getLogger("mark_deployment_status")
 formatter = logging.Formatter("[%(asctime)s] [%(name)s] [%(levelname)s]: %(message)s")
 log.addHandler(logging.StreamHandler(sys.stdout))
@@ -38,6 +52,22 @@ except Exception as e:
     log.error(e)
     exit(1)
 re_get_deployments = re.compile(r"{{deploy\|.*?}}", re.IGNORECASE)
+re_time_budget = re.compile(r"^(?P<amount>\d+(\.\d+)?)(?P<unit>[smh]?)$", re.IGNORECASE)
+# Gerrit stream-events we care about, and the change status each one implies
+gerrit_event_statuses = {
+    "change-merged": "MERGED",
+    "change-abandoned": "ABANDONED",
+}
+# Gerrit change details fetched during this run (None if not found), by Gerrit ID
+change_details_cache: dict[str, None | dict] = {}
+# SAL search results fetched during this run, by Gerrit ID
+sal_content_cache: dict[str, str] = {}
+# Change statuses we already know about (from Gerrit or stream-events), by Gerrit ID
+change_status_cache: dict[str, str] = {}
+# Gerrit IDs touched by stream-events (or that failed last run), waiting to be checked by `check_deployments`
+queued_gerrit_ids: set[str] = set()
+# Circuit breakers for the hosts we make requests to, by host
+circuit_breakers: dict[str, "CircuitBreaker"] = {}
 
 
 def get_request_session(
@@ -60,27 +90,93 @@ def get_request_session(
     return s
 
 
+class HostUnavailableError(Exception):
+    """Raised instead of making a request to a host whose circuit breaker is open"""
+
+    def __init__(self, host: str):
+        super().__init__(f"{host} is unavailable (circuit breaker open)")
+        self.host = host
+
+
+class CircuitBreaker:
+    def __init__(self, host: str, threshold: int = constants.CIRCUIT_BREAKER_THRESHOLD):
+        self.host = host
+        self.threshold = threshold
+        self.failures = 0
+
+    def is_open(self) -> bool:
+        """Whether the host has failed too many times in a row to keep trying it"""
+        return self.failures >= self.threshold
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.is_open():
+            log.error(
+                f"{self.host} failed {self.failures} times in a row, not contacting it again this run"
+            )
+
+
+def get_from_host(session: requests.Session, host: str, url: str) -> requests.Response:
+    """Make a GET request, going through the circuit breaker for the host"""
+    breaker = circuit_breakers.setdefault(host, CircuitBreaker(host))
+    if breaker.is_open():
+        raise HostUnavailableError(host)
+    try:
+        resp = session.get(url, timeout=6)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+    if resp.status_code >= 500 or resp.status_code == 429:
+        breaker.record_failure()
+        raise requests.HTTPError(f"{host} returned HTTP {resp.status_code}")
+    breaker.record_success()
+    return resp
+
+
+def is_host_unavailable(host: str) -> bool:
+    """Whether the circuit breaker for a host is open"""
+    breaker = circuit_breakers.get(host)
+    return breaker is not None and breaker.is_open()
+
+
 def get_change_details(change_id: str):
     """Get the details of a Gerrit change"""
+    if change_id in change_details_cache:
+        return change_details_cache[change_id]
     session = get_request_session(
         {
             "Accept": "application/json",
         }
     )
-    resp = session.get(
+    resp = get_from_host(
+        session,
+        constants.GERRIT_URL,
         f"https://{constants.GERRIT_URL}/r/changes/{change_id}",
-        timeout=6,
     )
-    if resp.status_code != 200:
+    if resp.status_code == 404:
+        # Remember missing changes too, so they aren't fetched again this run
+        change_details_cache[change_id] = None
         return None
+    if resp.status_code != 200:
+        # Anything else (e.g. 403 while rate limited) may work on a retry
+        raise requests.HTTPError(
+            f"{constants.GERRIT_URL} returned HTTP {resp.status_code} for {change_id}"
+        )
     data = resp.content[4:]
-    return json.loads(data)
+    change_details_cache[change_id] = json.loads(data)
+    return change_details_cache[change_id]
 
 
 def get_change_status(change_id: str) -> None | str:
     """Get the status of a Gerrit change"""
+    if change_id in change_status_cache:
+        return change_status_cache[change_id]
     change_details = get_change_details(change_id)
     if change_details:
+        change_status_cache[change_id] = change_details["status"]
         return change_details["status"]
     return None
 
@@ -93,6 +189,92 @@ def get_change_title(change_id: str) -> None | str:
     return None
 
 
+def read_gerrit_events(source: str, max_duration: float) -> Iterator[str]:
+    """Read Gerrit stream-events JSON lines from stdin (`-`), a socket (`tcp://host:port`) or a file, for at most `max_duration` seconds"""
+    deadline = time.monotonic() + max_duration
+    if source == "-":
+        # stdin can't time out on its own, so read it from a thread
+        lines: queue.Queue[None | str] = queue.Queue()
+
+        def read_stdin() -> None:
+            for line in sys.stdin:
+                lines.put(line)
+            lines.put(None)
+
+        threading.Thread(target=read_stdin, daemon=True).start()
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                stdin_line = lines.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if stdin_line is None:
+                return
+            yield stdin_line
+    elif source.startswith("tcp://"):
+        host, _, port = source.removeprefix("tcp://").rpartition(":")
+        with socket.create_connection((host, int(port)), timeout=10) as sock:
+            with sock.makefile("r", encoding="utf-8") as f:
+                while (remaining := deadline - time.monotonic()) > 0:
+                    sock.settimeout(remaining)
+                    try:
+                        line = f.readline()
+                    except TimeoutError:
+                        break
+                    if not line:
+                        return
+                    yield line
+    else:
+        with open(source, "r") as f:
+            for line in f:
+                if time.monotonic() >= deadline:
+                    break
+                yield line
+        return
+    if time.monotonic() >= deadline:
+        log.info(f"Read Gerrit events from {source} for {max_duration:g}s, stopping")
+
+
+def ingest_gerrit_event(line: str) -> None | str:
+    """Update the change status cache from a Gerrit event, returning the Gerrit ID it queued"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        event = json.loads(line)
+    except json.JSONDecodeError:
+        log.error(f"Skipping Gerrit event that is not valid JSON: {line[:80]}")
+        return None
+    if not isinstance(event, dict):
+        return None
+    new_status = gerrit_event_statuses.get(event.get("type", ""))
+    change = event.get("change")
+    if new_status is None or not isinstance(change, dict):
+        return None
+    if change.get("number") is None:
+        log.error(f"Skipping {event['type']} event without a change number")
+        return None
+    gerrit_id = str(change["number"])
+    log.debug(f"[{gerrit_id}]: Got {event['type']} event, status is now {new_status}")
+    change_status_cache[gerrit_id] = new_status
+    queued_gerrit_ids.add(gerrit_id)
+    return gerrit_id
+
+
+def ingest_gerrit_events(
+    source: str, max_duration: float, max_events: None | int = None
+) -> int:
+    """Ingest Gerrit stream-events from `source`, returning how many changes it queued"""
+    queued_from_events = set()
+    for event_count, line in enumerate(read_gerrit_events(source, max_duration), 1):
+        gerrit_id = ingest_gerrit_event(line)
+        if gerrit_id is not None:
+            queued_from_events.add(gerrit_id)
+        if max_events is not None and event_count >= max_events:
+            log.info(f"Read {event_count} Gerrit events from {source}, stopping")
+            break
+    return len(queued_from_events)
+
+
 def get_sal_entry_day(sal_content: str) -> str:
     """Get the date of the SAL entry"""
     sal_day = sal_day_regex.search(sal_content)
@@ -113,11 +295,14 @@ def did_change_get_deployed(
     gerrit_id: str, title: str, get_day: bool = False
 ) -> bool | re.Match[str] | tuple[re.Match[str], str]:
     """Find out if a change was deployed by checking the SAL on toolforge"""
-    session = get_request_session()
-    sal_content = session.get(
-        f"https://{constants.SAL_URL}/production?p=0&q={gerrit_id}&d=",
-        timeout=6,
-    ).text
+    if gerrit_id not in sal_content_cache:
+        session = get_request_session()
+        sal_content_cache[gerrit_id] = get_from_host(
+            session,
+            constants.SAL_URL,
+            f"https://{constants.SAL_URL}/production?p=0&q={gerrit_id}&d=",
+        ).text
+    sal_content = sal_content_cache[gerrit_id]
     in_log = get_sal_entry_regex(title, gerrit_id).search(sal_content)
     if in_log is not None:
         if get_day:
@@ -128,6 +313,102 @@ def did_change_get_deployed(
     return False
 
 
+def lookup_change_status(change_id: str) -> dict[str, None | str]:
+    """Look up the patchset status of a change"""
+    return {"id": change_id, "status": get_change_status(change_id)}
+
+
+def lookup_deployment_status(change_id: str) -> dict[str, None | str]:
+    """Look up the title, status and SAL entry of a change"""
+    result: dict[str, None | str] = {
+        "id": change_id,
+        "title": get_change_title(change_id),
+        "status": get_change_status(change_id),
+        "deployer": None,
+        "deployed_on": None,
+        "sal": None,
+    }
+    if result["title"] is None or result["status"] is None:
+        return result
+    deployment_status = did_change_get_deployed(
+        change_id, result["title"], get_day=True
+    )
+    if isinstance(deployment_status, tuple):
+        deployment_status, result["deployed_on"] = deployment_status
+    if isinstance(deployment_status, re.Match):
+        result["deployer"] = deployment_status.group("deployer")
+        result[
+            "sal"
+        ] = f"https://{constants.SAL_URL}{deployment_status.group('sal_link')}"
+    return result
+
+
+def format_change_status(result: dict[str, None | str]) -> str:
+    """Format a change status lookup for humans"""
+    if result.get("error"):
+        return f"[{result['id']}]: Error looking up change: {result['error']}"
+    if result["status"] is None:
+        return f"[{result['id']}]: Change not found"
+    return f"[{result['id']}]: Change status: {result['status']}"
+
+
+def format_deployment_status(result: dict[str, None | str]) -> str:
+    """Format a deployment status lookup for humans"""
+    if result.get("error"):
+        return f"[{result['id']}]: Error looking up change: {result['error']}"
+    if result["title"] is None or result["status"] is None:
+        return f"[{result['id']}]: Change not found"
+    lines = [
+        f"[{result['id']}]: Change title: {result['title']}",
+        f"[{result['id']}]: Change status: {result['status']}",
+    ]
+    if result["sal"] is None:
+        lines.append(f"[{result['id']}]: Change not deployed")
+    elif result["deployed_on"] is not None:
+        lines.append(
+            f"[{result['id']}]: Change deployed on {result['deployed_on']} by {result['deployer']} ({result['sal']})"
+        )
+    else:
+        lines.append(
+            f"[{result['id']}]: Change deployed by {result['deployer']} ({result['sal']})"
+        )
+    return "\n".join(lines)
+
+
+def read_change_ids(values: list[str]) -> list[str]:
+    """Collect change IDs from the command line, reading them from stdin for `-`"""
+    change_ids = []
+    for value in values:
+        if value == "-":
+            change_ids.extend(sys.stdin.read().split())
+        else:
+            change_ids.append(value)
+    # Drop duplicates so each change is only fetched once
+    return list(dict.fromkeys(change_ids))
+
+
+def run_bulk_lookup(
+    change_ids: list[str],
+    lookup: Callable[[str], dict[str, None | str]],
+    formatter: Callable[[dict[str, None | str]], str],
+    output_format: str = "text",
+) -> None:
+    """Look up many changes concurrently, printing each result as soon as it's ready"""
+    with ThreadPoolExecutor(max_workers=constants.LOOKUP_WORKERS) as executor:
+        futures = {
+            executor.submit(lookup, change_id): change_id for change_id in change_ids
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"id": futures[future], "error": str(e)}
+            if output_format == "json":
+                print(json.dumps(result), flush=True)
+            else:
+                print(formatter(result), flush=True)
+
+
 def map_deployment_status(actual_status: str) -> None | str:
     """Map Gerrit statuses to deployment statuses"""
     new_status = None
@@ -246,6 +527,43 @@ def normalise_deployment_status(deployment: str) -> str:
     return deployment
 
 
+def get_deployment_priority(deployment_obj: Backports.Deployment) -> None | int:
+    """Get the scheduling priority of a deployment (lower goes first, None means no work)"""
+    if deployment_obj.status == "":
+        return 0
+    if (
+        normalise_deployment_status(deployment_obj.deployment)
+        != deployment_obj.deployment
+    ):
+        return 1
+    if deployment_obj.status == "done" and (
+        "sal=" not in deployment_obj.deployment
+        or "by=" not in deployment_obj.deployment
+    ):
+        return 2
+    if deployment_obj.status == "unknown":
+        return 3
+    return None
+
+
+def parse_time_budget(time_budget: str) -> float:
+    """Parse a time budget such as `90s`, `5m` or `1h` into seconds"""
+    match = re_time_budget.match(time_budget.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(
+            f"invalid time budget: {time_budget!r} (expected e.g. 90s, 5m or 1h)"
+        )
+    multiplier = {"": 1, "s": 1, "m": 60, "h": 3600}[match.group("unit").lower()]
+    return float(match.group("amount")) * multiplier
+
+
+def describe_run_limit() -> str:
+    """Describe what bounds this run, for log messages"""
+    if args.time_budget is not None:
+        return f"time budget of {args.time_budget:g}s"
+    return f"limited to {args.limit} changes"
+
+
 def handle_reported_status(
     reported_status: str,
     deployment: str,
@@ -331,6 +649,81 @@ def handle_reported_status(
     return deployments_to_update, count
 
 
+def plan_page_changes(
+    page_content: str, deployments_to_update: dict[str, str]
+) -> list[Backports.PlannedChange]:
+    """Turn template updates into changes anchored to the sections they appear in"""
+    planned_changes: dict[tuple[tuple[str, ...], str], Backports.PlannedChange] = {}
+    for match in re_get_deployments.finditer(page_content):
+        deployment = match.group(0)
+        if deployment not in deployments_to_update:
+            continue
+        section_path = Backports.get_section_path(page_content, match.start())
+        if (section_path, deployment) not in planned_changes:
+            planned_changes[(section_path, deployment)] = Backports.PlannedChange(
+                section_path, deployment, deployments_to_update[deployment]
+            )
+    return list(planned_changes.values())
+
+
+def apply_planned_changes(
+    page_content: str, planned_changes: list[Backports.PlannedChange]
+) -> tuple[str, int]:
+    """Apply the planned changes that still apply, returning the new content and how many applied"""
+    applied = 0
+    for planned_change in planned_changes:
+        updated_content = planned_change.apply(page_content)
+        if updated_content is None:
+            log.debug(
+                f"Planned change no longer applies in {' > '.join(planned_change.section_path) or 'the lead'}: {planned_change.old}"
+            )
+            continue
+        page_content = updated_content
+        applied += 1
+    return page_content, applied
+
+
+def save_planned_changes(
+    base_content: str, planned_changes: list[Backports.PlannedChange], summary: str
+) -> bool:
+    """Save the planned changes, reapplying them onto the latest revision if the page was edited meanwhile"""
+    for attempt in range(1, constants.EDIT_ATTEMPTS + 1):
+        # pwiki can't send a base timestamp with the edit, so check for conflicts ourselves
+        latest_content = wiki.page_text(config.DEPLOYMENT_PAGE)
+        if latest_content is None:
+            log.error(
+                f"Could not fetch {config.DEPLOYMENT_PAGE} (deleted or moved during the run?), not saving"
+            )
+            return False
+        if latest_content != base_content:
+            log.info(
+                f"{config.DEPLOYMENT_PAGE} was edited during the run, reapplying planned changes onto the latest revision..."
+            )
+        new_page_content, applied = apply_planned_changes(
+            latest_content, planned_changes
+        )
+        if applied < len(planned_changes):
+            log.info(
+                f"{len(planned_changes) - applied} of {len(planned_changes)} planned changes no longer apply, skipping them"
+            )
+        if new_page_content == latest_content:
+            log.info("Nothing left to change on the latest revision")
+            return False
+        if wiki.edit(
+            title=config.DEPLOYMENT_PAGE,
+            text=new_page_content,
+            summary=summary,
+            minor=True,
+        ):
+            return True
+        # pwiki doesn't tell us why an edit failed, so this isn't necessarily a conflict
+        log.error(
+            f"Edit attempt {attempt}/{constants.EDIT_ATTEMPTS} failed (reason unknown), retrying blindly against the latest revision"
+        )
+        base_content = latest_content
+    return False
+
+
 def copy_for_testing(copy_from, copy_to) -> bool:
     """Copy the content of a page to another page for testing purposes"""
     # Check if the page exists
@@ -378,6 +771,124 @@ def log_to_wiki(message: str) -> None:
             )
 
 
+def apply_duplicate_policy(
+    candidates: list[Backports.Deployment], policy: str
+) -> list[Backports.Deployment]:
+    """Group deployments by Gerrit ID and drop duplicates according to the policy"""
+    deployments_by_gerrit_id: dict[str, list[Backports.Deployment]] = {}
+    for deployment_obj in candidates:
+        if deployment_obj.gerrit_id is not None:
+            deployments_by_gerrit_id.setdefault(deployment_obj.gerrit_id, []).append(
+                deployment_obj
+            )
+    flagged_gerrit_ids = []
+    for gerrit_id, deployments in deployments_by_gerrit_id.items():
+        if len(deployments) < 2:
+            continue
+        if policy == "newest":
+            log.info(
+                f"[{gerrit_id}]: Found {len(deployments)} entries, only checking the newest"
+            )
+        elif policy == "flag":
+            log.error(
+                f"[{gerrit_id}]: Found {len(deployments)} entries, not updating any of them"
+            )
+            flagged_gerrit_ids.append(gerrit_id)
+        else:
+            log.info(
+                f"[{gerrit_id}]: Found {len(deployments)} entries, checking all of them"
+            )
+    if args.log_to_wiki and len(flagged_gerrit_ids) > 0:
+        # One message for all of them, as every log is a separate wiki edit
+        log_to_wiki(
+            f"Found duplicate entries on [[{config.DEPLOYMENT_PAGE}]], not updating any of them: {', '.join(f'[[gerrit:{i}|{i}]]' for i in flagged_gerrit_ids)}"
+        )
+
+    def keep(deployment_obj: Backports.Deployment) -> bool:
+        if deployment_obj.gerrit_id is None:
+            return True
+        deployments = deployments_by_gerrit_id[deployment_obj.gerrit_id]
+        if policy == "newest":
+            # Candidates are most recent first
+            return deployment_obj is deployments[0]
+        if policy == "flag":
+            return len(deployments) == 1
+        return True
+
+    return [deployment_obj for deployment_obj in candidates if keep(deployment_obj)]
+
+
+def load_failed_gerrit_ids() -> list[str]:
+    """Load the Gerrit IDs that failed on the previous run"""
+    try:
+        with open(constants.FAILED_IDS_FILE, "r") as f:
+            return [str(gerrit_id) for gerrit_id in json.load(f)]
+    except json.JSONDecodeError:
+        log.error(f"{constants.FAILED_IDS_FILE} is not valid JSON")
+        return []
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        log.error(f"Could not read {constants.FAILED_IDS_FILE}: {e}")
+        return []
+
+
+def record_failed_gerrit_ids(failed_gerrit_ids: set[str]) -> None:
+    """Record the Gerrit IDs that failed on this run, so the next run can retry them"""
+    try:
+        with open(constants.FAILED_IDS_FILE, "w") as f:
+            json.dump(sorted(failed_gerrit_ids), f)
+    except OSError as e:
+        log.error(
+            f"Could not record failed Gerrit IDs in {constants.FAILED_IDS_FILE}: {e}"
+        )
+
+
+def resolve_deployment(
+    deployment_obj: Backports.Deployment,
+    page_content: str,
+    deployments_to_update: dict[str, str],
+    count: int,
+) -> tuple[dict[str, str], int]:
+    """Look up a (validated) deployment's change and work out its update, raising on request errors"""
+    deployment = deployment_obj.deployment
+    gerrit_id = str(deployment_obj.gerrit_id)
+    reported_status = str(deployment_obj.status)
+    deployment_title = deployment_obj.title
+    deployment_type = deployment_obj.type
+    # get actual status, letting request errors through to the caller
+    actual_status = get_change_status(gerrit_id)
+    queued_gerrit_ids.discard(gerrit_id)
+
+    if actual_status is None:
+        log.info(f"[{gerrit_id}]: Could not get actual status for {gerrit_id}")
+        return deployments_to_update, count
+
+    log.info(
+        f"[{gerrit_id}]: Checking status for {gerrit_id}: {deployment_title} ({deployment_type})"
+    )
+    log.info(f"[{gerrit_id}]: Actual status (according to Gerrit) is {actual_status}")
+    if reported_status == "" and actual_status == "NEW":
+        log.debug(
+            f"[{gerrit_id}]: Reported status is empty and actual status is new, no need to update."
+        )
+        return deployments_to_update, count
+
+    # TODO: `count` here could just be `len(deployments_to_update)`, right..?
+    deployments_to_update, count = handle_reported_status(
+        reported_status,
+        deployment,
+        actual_status,
+        gerrit_id,
+        page_content,
+        deployments_to_update,
+        count,
+    )
+    if args.verbose:
+        log.debug(f"len(deployments_to_update): {len(deployments_to_update)} ({count})")
+    return deployments_to_update, count
+
+
 def check_deployments(page_content: str) -> None:
     """Check deployments and update status if needed"""
     all_deployments = re_get_deployments.findall(page_content)
@@ -392,94 +903,151 @@ def check_deployments(page_content: str) -> None:
         log.info("No deployments found, exiting...")
         return
     deployments_to_update: dict[str, str] = {}
-    seen_gerrit_ids = []
+    resolved_gerrit_ids: set[str] = set()
+    retry_queue: list[Backports.Deployment] = []
+    failed_gerrit_ids: set[str] = set()
+    checked_gerrit_ids: set[str] = set()
+    gerrit_unavailable = False
     limit = args.limit
     count = 0
     # We start from the most recent deployments, hence the `reversed`
+    candidates = []
     for deployment in reversed(all_deployments):
-        if count >= limit:
-            break
-        # Slow down the requests to avoid hitting the API too hard
-        time.sleep(0.2 + random.uniform(0, 0.5))
-        # Parse deployment
         deployment_obj = Backports.Deployment(deployment)
-        gerrit_id = deployment_obj.gerrit_id
-        reported_status = deployment_obj.status
-        deployment_title = deployment_obj.title
-        deployment_type = deployment_obj.type
-
+        # Drop malformed templates before grouping duplicates, so they can't
+        # stand in for a valid entry with the same Gerrit ID
         if (
-            gerrit_id is None
-            or reported_status is None
-            or deployment_title is None
-            or deployment_type is None
+            deployment_obj.gerrit_id is None
+            or deployment_obj.status is None
+            or deployment_obj.title is None
+            or deployment_obj.type is None
         ):
             log.info(
                 "Missing gerrit id/reported status/deployment title/deployment type"
             )
             continue
+        candidates.append(deployment_obj)
+    page_gerrit_ids = {str(c.gerrit_id) for c in candidates}
+    if args.events is not None or args.retry_failed:
+        # Only look at the templates affected by the Gerrit events we ingested,
+        # or that failed on the previous run
+        candidates = [c for c in candidates if c.gerrit_id in queued_gerrit_ids]
+        log.info(
+            f"{len(candidates)} deployments are affected by {len(queued_gerrit_ids)} queued Gerrit changes"
+        )
+    candidates = apply_duplicate_policy(candidates, args.duplicates)
+    deadline = None
+    if args.time_budget is not None:
+        # Only keep deployments that need work, most valuable first. `sorted` is
+        # stable, so within a priority the most recent deployments still go first.
+        candidates = sorted(
+            (c for c in candidates if get_deployment_priority(c) is not None),
+            key=get_deployment_priority,
+        )
+        log.info(
+            f"{len(candidates)} deployments need work, running with a {describe_run_limit()}"
+        )
+        deadline = time.monotonic() + args.time_budget
+    for index, deployment_obj in enumerate(candidates):
+        if deadline is not None:
+            if time.monotonic() >= deadline:
+                log.info(
+                    f"Time budget exhausted, leaving {len(candidates) - index} deployments for the next run"
+                )
+                break
+        elif count >= limit:
+            break
+        # Candidates have been validated already
+        gerrit_id = str(deployment_obj.gerrit_id)
 
         if args.id and int(gerrit_id) != args.id:
             continue
 
-        # Check if we've already seen this Gerrit ID
-        if gerrit_id in seen_gerrit_ids:
-            log.error(f"[{gerrit_id}]: Duplicate Gerrit ID found?!")
-            if args.ignore_duplicates:
-                log.info(f"[{gerrit_id}]: Ignoring duplicate Gerrit ID")
-                continue
-            # TODO: Handle this maybe?
-            pass
-        seen_gerrit_ids.append(gerrit_id)
-
-        try:
-            # get actual status
-            actual_status = get_change_status(gerrit_id)
-        except Exception as e:
-            log.error(f"[{gerrit_id}]: Error getting actual status: {e}")
-            sys.exit(1)
+        if gerrit_id not in change_status_cache and is_host_unavailable(
+            constants.GERRIT_URL
+        ):
+            # Every remaining deployment needs Gerrit too, so don't bother trying them
+            log.error(
+                f"{constants.GERRIT_URL} is unavailable, stopping and leaving {len(candidates) - index} deployments for the next run"
+            )
+            gerrit_unavailable = True
+            break
 
-        if actual_status is None:
-            log.info(f"[{gerrit_id}]: Could not get actual status for {gerrit_id}")
-            continue
+        # Duplicates share the first lookup, so only slow down for new Gerrit IDs
+        if gerrit_id not in resolved_gerrit_ids:
+            # Slow down the requests to avoid hitting the API too hard
+            time.sleep(0.2 + random.uniform(0, 0.5))
+        resolved_gerrit_ids.add(gerrit_id)
 
+        try:
+            deployments_to_update, count = resolve_deployment(
+                deployment_obj, page_content, deployments_to_update, count
+            )
+            checked_gerrit_ids.add(gerrit_id)
+        except HostUnavailableError as e:
+            # The SAL is down (Gerrit being down is caught before the request)
+            log.error(f"[{gerrit_id}]: Error checking deployment: {e}")
+            failed_gerrit_ids.add(gerrit_id)
+        except requests.RequestException as e:
+            log.error(f"[{gerrit_id}]: Error checking deployment: {e}")
+            if len(retry_queue) >= constants.RETRY_QUEUE_SIZE:
+                failed_gerrit_ids.add(gerrit_id)
+            else:
+                retry_queue.append(deployment_obj)
+        print()
+    for attempt in range(1, constants.RETRY_ATTEMPTS + 1):
+        if len(retry_queue) == 0 or gerrit_unavailable:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            log.info("Time budget exhausted, not retrying failed deployments")
+            break
         log.info(
-            f"[{gerrit_id}]: Checking status for {gerrit_id}: {deployment_title} ({deployment_type})"
-        )
-        log.info(
-            f"[{gerrit_id}]: Actual status (according to Gerrit) is {actual_status}"
+            f"Retrying {len(retry_queue)} failed deployments (attempt {attempt}/{constants.RETRY_ATTEMPTS})..."
         )
-        if reported_status == "" and actual_status == "NEW":
-            log.debug(
-                f"[{gerrit_id}]: Reported status is empty and actual status is new, no need to update."
-            )
-            continue
-
-        # TODO: `count` here could just be `len(deployments_to_update)`, right..?
-        deployments_to_update, count = handle_reported_status(
-            reported_status,
-            deployment,
-            actual_status,
-            gerrit_id,
-            page_content,
-            deployments_to_update,
-            count,
+        still_failing = []
+        for index, deployment_obj in enumerate(retry_queue):
+            if is_host_unavailable(constants.GERRIT_URL):
+                gerrit_unavailable = True
+                still_failing.extend(retry_queue[index:])
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                log.info("Time budget exhausted, not retrying the remaining failures")
+                still_failing.extend(retry_queue[index:])
+                break
+            time.sleep(0.2 + random.uniform(0, 0.5))
+            try:
+                deployments_to_update, count = resolve_deployment(
+                    deployment_obj, page_content, deployments_to_update, count
+                )
+                checked_gerrit_ids.add(str(deployment_obj.gerrit_id))
+            except (requests.RequestException, HostUnavailableError) as e:
+                log.error(
+                    f"[{deployment_obj.gerrit_id}]: Error checking deployment: {e}"
+                )
+                still_failing.append(deployment_obj)
+        retry_queue = still_failing
+    failed_gerrit_ids.update(str(d.gerrit_id) for d in retry_queue)
+    if len(failed_gerrit_ids) > 0:
+        log.error(
+            f"Could not check {len(failed_gerrit_ids)} Gerrit changes, they will be retried with --retry-failed: {', '.join(sorted(failed_gerrit_ids))}"
         )
-        if args.verbose:
-            log.debug(
-                f"len(deployments_to_update): {len(deployments_to_update)} ({count})"
+        if args.log_to_wiki:
+            log_to_wiki(
+                f"Could not check {len(failed_gerrit_ids)} Gerrit changes on [[{config.DEPLOYMENT_PAGE}]]: {', '.join(f'[[gerrit:{i}|{i}]]' for i in sorted(failed_gerrit_ids))}"
             )
-        print()
     print()
     if len(deployments_to_update) > 0:
         log.info(f"Found {len(deployments_to_update)} deployments to update")
         if args.log_to_wiki:
-            log_message = f"Out of {len(all_deployments)} total deployments on [[{config.DEPLOYMENT_PAGE}]], there are {len(deployments_to_update)} deployments (limited to {args.limit} changes) to update"
+            log_message = f"Out of {len(all_deployments)} total deployments on [[{config.DEPLOYMENT_PAGE}]], there are {len(deployments_to_update)} deployments ({describe_run_limit()}) to update"
             if args.id:
                 log_message += f" (will only modify item with change ID: [[gerrit:{args.id}|{args.id}]])"
             log_to_wiki(log_message)
-        new_page_content = page_content
-        edit_summary = f"{config.EDIT_SUMMARY} [t:{len(all_deployments)}/u:{len(deployments_to_update)}/l:{args.limit}]"
+        if args.time_budget is not None:
+            run_limit_tag = f"b:{args.time_budget:g}s"
+        else:
+            run_limit_tag = f"l:{args.limit}"
+        edit_summary = f"{config.EDIT_SUMMARY} [t:{len(all_deployments)}/u:{len(deployments_to_update)}/{run_limit_tag}]"
         if args.id:
             edit_summary += f" (change ID: [[gerrit:{args.id}|{args.id}]])"
         if args.verbose:
@@ -489,28 +1057,24 @@ def check_deployments(page_content: str) -> None:
                 log.info(
                     f"Deployment {deployment} will be updated to {deployments_to_update[deployment]}"
                 )
-            new_page_content = new_page_content.replace(
-                deployment, deployments_to_update[deployment]
-            )
+        planned_changes = plan_page_changes(page_content, deployments_to_update)
+        new_page_content, _ = apply_planned_changes(page_content, planned_changes)
         if args.dry is False and new_page_content != page_content:
             log.info("Updating page...")
-            edit_result = wiki.edit(
-                title=config.DEPLOYMENT_PAGE,
-                text=new_page_content,
-                summary=edit_summary,
-                minor=True,
+            edit_result = save_planned_changes(
+                page_content, planned_changes, edit_summary
             )
             if edit_result:
                 log.info("Page updated successfully")
                 if args.log_to_wiki:
-                    log_message = f'<span style="color:green;">Successfully</span> updated {len(deployments_to_update)} deployments (limited to {args.limit} changes) on [[{config.DEPLOYMENT_PAGE}]]'  # noqa: E702
+                    log_message = f'<span style="color:green;">Successfully</span> updated {len(deployments_to_update)} deployments ({describe_run_limit()}) on [[{config.DEPLOYMENT_PAGE}]]'  # noqa: E702
                     if args.id:
                         log_message += f" (will only modify item with change ID: [[gerrit:{args.id}|{args.id}]])"
                     log_to_wiki(log_message)
             else:
                 log.error("Failed to update page")
                 if args.log_to_wiki:
-                    log_message = f'<span style="color:red;">Failed</span> to update {len(deployments_to_update)} deployments (limited to {args.limit} changes) on [[{config.DEPLOYMENT_PAGE}]]'  # noqa: E702
+                    log_message = f'<span style="color:red;">Failed</span> to update {len(deployments_to_update)} deployments ({describe_run_limit()}) on [[{config.DEPLOYMENT_PAGE}]]'  # noqa: E702
                     if args.id:
                         log_message += f" (will only modify item with change ID: [[gerrit:{args.id}|{args.id}]])"
                     log_to_wiki(log_message)
@@ -519,19 +1083,26 @@ def check_deployments(page_content: str) -> None:
                 f.write(page_content)
             with open("logs/deployments_updated.txt", "w") as f:
                 f.write(new_page_content)
+    if args.dry is False:
+        # Runs can cover only part of the page, so keep earlier failures we didn't
+        # get to, unless their templates are gone from the page (e.g. archived)
+        pending_gerrit_ids = (
+            (set(load_failed_gerrit_ids()) & page_gerrit_ids) - checked_gerrit_ids
+        ) | failed_gerrit_ids
+        record_failed_gerrit_ids(pending_gerrit_ids)
 
 
 def main() -> None:
     log.info(f"Getting deployments from {config.DEPLOYMENT_PAGE}...")
     if args.log_to_wiki:
-        log_message = f"'''Beginning''' run for [[{config.DEPLOYMENT_PAGE}]] (limited to {args.limit} changes)"
+        log_message = f"'''Beginning''' run for [[{config.DEPLOYMENT_PAGE}]] ({describe_run_limit()})"
         if args.id:
             log_message += f" (will only modify item with change ID: [[gerrit:{args.id}|{args.id}]])"
         log_to_wiki(log_message)
     page_content = wiki.page_text(config.DEPLOYMENT_PAGE)
     check_deployments(page_content)
     if args.log_to_wiki:
-        log_message = f"'''Run completed''' for [[{config.DEPLOYMENT_PAGE}]] (limited to {args.limit} changes)"
+        log_message = f"'''Run completed''' for [[{config.DEPLOYMENT_PAGE}]] ({describe_run_limit()})"
         log_to_wiki(log_message)
 
 
@@ -550,7 +1121,9 @@ if __name__ == "__main__":
         action="store_true",
     )
     parser.add_argument(
-        "--ignore-duplicates", help="Ignore duplicate Gerrit IDs", action="store_true"
+        "--ignore-duplicates",
+        help="Only check the newest entry for duplicate Gerrit IDs (same as --duplicates newest)",
+        action="store_true",
     )
     parser.add_argument(
         "--debug", help="Set log level to DEBUG, write logs etc.", action="store_true"
@@ -567,6 +1140,18 @@ if __name__ == "__main__":
         default=60,
         metavar="60",
     )
+    parser.add_argument(
+        "--time-budget",
+        help="Work through deployments by priority until this much time has passed (e.g. 90s, 5m), instead of using --limit",
+        type=parse_time_budget,
+        metavar="90s",
+    )
+    parser.add_argument(
+        "--duplicates",
+        help="What to do with entries sharing a Gerrit ID: update all of them, only the newest, or flag them and update none (default: all)",
+        choices=["all", "newest", "flag"],
+        default="all",
+    )
     parser.add_argument(
         "--id",
         help="Just update the status of a single deployment (by gerrit id)",
@@ -579,18 +1164,50 @@ if __name__ == "__main__":
         type=str,
         default=config.DEPLOYMENT_PAGE,
     )
+    parser.add_argument(
+        "--events",
+        help="Read Gerrit stream-events JSON lines from a file, tcp://host:port or - (stdin) and only check the changes they mention",
+        type=str,
+        metavar="SOURCE",
+    )
+    parser.add_argument(
+        "--events-duration",
+        help="Stop reading --events after this long, so a continuous stream still gets a pass (default: 60s)",
+        type=parse_time_budget,
+        default=60.0,
+        metavar="60s",
+    )
+    parser.add_argument(
+        "--events-limit",
+        help="Stop reading --events after this many events",
+        type=int,
+        metavar="500",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        help=f"Only check the changes that could not be checked on the previous run (recorded in {constants.FAILED_IDS_FILE})",
+        action="store_true",
+    )
     parser.add_argument(
         "--get-change-status",
-        help="Get the patchset status of a change by Gerrit ID and quit",
+        help="Get the patchset status of changes by Gerrit ID (- reads IDs from stdin) and quit",
         type=str,
+        nargs="+",
         metavar="12345",
     )
     parser.add_argument(
         "--get-deployment-status",
-        help="Get the deployment status of a change by Gerrit ID and quit",
+        help="Get the deployment status of changes by Gerrit ID (- reads IDs from stdin) and quit",
         type=str,
+        nargs="+",
         metavar="12345",
     )
+    parser.add_argument(
+        "--output",
+        help="Output format for --get-change-status/--get-deployment-status (default: text)",
+        choices=["text", "json"],
+        default="text",
+    )
     # Hidden args
     # Copy the content of the DEPLOYMENT_PAGE to the page provided (for testing)
     parser.add_argument(
@@ -617,42 +1234,20 @@ if __name__ == "__main__":
             print("Sorry, we're all out of quirky messages")
         sys.exit(0)
     if args.get_change_status:
-        change_status = get_change_status(args.get_change_status)
-        if change_status:
-            print(f"Change status: {change_status}")
-        else:
-            print("Change not found")
+        run_bulk_lookup(
+            read_change_ids(args.get_change_status),
+            lookup_change_status,
+            format_change_status,
+            args.output,
+        )
         sys.exit(0)
     if args.get_deployment_status:
-        print(
-            f"Getting deployment status for [[gerrit:{args.get_deployment_status}]]..."
+        run_bulk_lookup(
+            read_change_ids(args.get_deployment_status),
+            lookup_deployment_status,
+            format_deployment_status,
+            args.output,
         )
-        change_title = get_change_title(args.get_deployment_status)
-        change_status = get_change_status(args.get_deployment_status)
-        if change_title and change_status:
-            print(f"Change title: {change_title}")
-            print(f"Change status: {change_status}")
-            deployment_status = did_change_get_deployed(
-                args.get_deployment_status, change_title, get_day=True
-            )
-            if deployment_status:
-                if isinstance(deployment_status, tuple):
-                    deployment_match = deployment_status[0]
-                    deployment_day = deployment_status[1]
-                    print(
-                        f"Change deployed on {deployment_day} by {deployment_match.group('deployer')} (https://{constants.SAL_URL}{deployment_match.group('sal_link')})"
-                    )  # noqa: E501
-                elif isinstance(deployment_status, re.Match):
-                    print(
-                        f"Change deployed by {deployment_status.group('deployer')} (https://{constants.SAL_URL}{deployment_status.group('sal_link')})"
-                    )  # noqa: E501
-                else:
-                    print("Unknown deployment status")
-                    sys.exit(1)
-            else:
-                print("Change not deployed")
-        else:
-            print("Change not found")
         sys.exit(0)
     if args.version:
         print(constants.VERSION_STRING)
@@ -693,5 +1288,32 @@ if __name__ == "__main__":
                 text="Log page for mark-deployment-status.py\n\n",
                 summary="Creating log page",
             )
-    log.debug(f"Limiting to updating {args.limit} deployments")
+    if args.ignore_duplicates:
+        args.duplicates = "newest"
+    if args.retry_failed:
+        queued_gerrit_ids.update(load_failed_gerrit_ids())
+        log.info(f"Retrying {len(queued_gerrit_ids)} changes that failed last run")
+        if len(queued_gerrit_ids) == 0 and args.events is None:
+            log.info("No failed changes from the previous run to retry, exiting...")
+            sys.exit(0)
+    if args.events is not None:
+        log.info(f"Reading Gerrit events from {args.events}...")
+        try:
+            queued_count = ingest_gerrit_events(
+                args.events, args.events_duration, args.events_limit
+            )
+        except FileNotFoundError:
+            log.error(f"{args.events} not found")
+            sys.exit(1)
+        except (OSError, ValueError) as e:
+            log.error(f"Could not read Gerrit events from {args.events}: {e}")
+            sys.exit(1)
+        log.info(f"Queued {queued_count} changes from Gerrit events")
+        if len(queued_gerrit_ids) == 0:
+            log.info("No merged or abandoned changes in the Gerrit events, exiting...")
+            sys.exit(0)
+    if args.time_budget is not None:
+        log.debug(f"Running with a time budget of {args.time_budget:g}s")
+    else:
+        log.debug(f"Limiting to updating {args.limit} deployments")
     main()
@@ -1,4 +1,38 @@
 import mark_deployment_status
+import pytest
+
+
+@pytest.fixture
+def run_check_deployments(mocker, tmp_path):
+    """Run check_deployments with fresh run state, no sleeps and a mocked wiki"""
+    mocker.patch.object(
+        mark_deployment_status.constants,
+        "FAILED_IDS_FILE",
+        str(tmp_path / "failed_gerrit_ids.json"),
+    )
+    mocker.patch.dict(mark_deployment_status.change_details_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.sal_content_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.change_status_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.circuit_breakers, clear=True)
+    mocker.patch.object(mark_deployment_status, "queued_gerrit_ids", set())
+    mocker.patch("mark_deployment_status.time.sleep")
+    mocker.patch.object(
+        mark_deployment_status,
+        "args",
+        mark_deployment_status.argparse.Namespace(
+            **vars(mark_deployment_status.args), id=None, debug=False
+        ),
+    )
+    page_text = mocker.patch.object(mark_deployment_status.wiki, "page_text")
+    edit = mocker.patch.object(mark_deployment_status.wiki, "edit", return_value=True)
+
+    def run(page_content, **arg_overrides):
+        vars(mark_deployment_status.args).update(arg_overrides)
+        page_text.return_value = page_content
+        mark_deployment_status.check_deployments(page_content)
+        return edit
+
+    return run
 
 
 def test_update_deployment_status(mocker):
@@ -50,3 +84,374 @@ def test_update_deployment_status_nobullet(mocker):
         )
         == deployment_string_post
     )
+
+
+def test_parse_time_budget():
+    assert mark_deployment_status.parse_time_budget("90s") == 90
+    assert mark_deployment_status.parse_time_budget("90") == 90
+    assert mark_deployment_status.parse_time_budget("2m") == 120
+    assert mark_deployment_status.parse_time_budget("1h") == 3600
+
+
+def test_get_deployment_priority():
+    empty = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=1|title=Empty|status=}}"
+    )
+    normalise = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=2|title=Normalise|status=d}}"
+    )
+    missing = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=3|title=Missing|status=done}}"
+    )
+    unknown = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=4|title=Unknown|status=unknown}}"
+    )
+    complete = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=5|title=Complete|status=done|by=samtar|sal=https://sal.toolforge.org/log/x}}"
+    )
+    assert mark_deployment_status.get_deployment_priority(empty) == 0
+    assert mark_deployment_status.get_deployment_priority(normalise) == 1
+    assert mark_deployment_status.get_deployment_priority(missing) == 2
+    assert mark_deployment_status.get_deployment_priority(unknown) == 3
+    assert mark_deployment_status.get_deployment_priority(complete) is None
+
+
+def test_ingest_gerrit_events(mocker, tmp_path):
+    mocker.patch.dict(mark_deployment_status.change_status_cache, clear=True)
+    # e.g. loaded by --retry-failed, which shouldn't count as queued by the events
+    mocker.patch.object(mark_deployment_status, "queued_gerrit_ids", {"1101500"})
+    get_change_details = mocker.patch(
+        "mark_deployment_status.get_change_details", return_value=None
+    )
+    events_file = tmp_path / "events.json"
+    events_file.write_text(
+        '{"type": "change-merged", "change": {"number": 1101577, "status": "MERGED"}}\n'
+        '{"type": "comment-added", "change": {"number": 1101578}}\n'
+        "not json\n"
+        '{"type": "change-abandoned", "change": {"number": 1101579}}\n'
+    )
+    assert mark_deployment_status.ingest_gerrit_events(str(events_file), 60) == 2
+    assert mark_deployment_status.queued_gerrit_ids == {
+        "1101500",
+        "1101577",
+        "1101579",
+    }
+    assert mark_deployment_status.get_change_status("1101577") == "MERGED"
+    assert mark_deployment_status.get_change_status("1101579") == "ABANDONED"
+    get_change_details.assert_not_called()
+
+
+def test_save_planned_changes_rebases_onto_latest_revision(mocker):
+    first = "{{deploy|type=config|gerrit=1|title=First|status=}}"
+    second = "{{deploy|type=config|gerrit=2|title=Second|status=}}"
+    base_content = (
+        f"== Monday ==\n=== Morning ===\n{first}\n=== Evening ===\n{second}\n"
+    )
+    planned_changes = mark_deployment_status.plan_page_changes(
+        base_content,
+        {
+            first: first.replace("status=", "status=done"),
+            second: second.replace("status=", "status=done"),
+        },
+    )
+    assert [change.section_path for change in planned_changes] == [
+        ("Monday", "Morning"),
+        ("Monday", "Evening"),
+    ]
+    # A deployer marked the second item themselves and added a new one meanwhile
+    latest_content = base_content.replace(
+        second, second.replace("status=", "status=not done")
+    ).replace("=== Evening ===\n", "=== Evening ===\n* A new item\n")
+    mocker.patch.object(
+        mark_deployment_status.wiki, "page_text", return_value=latest_content
+    )
+    edit = mocker.patch.object(mark_deployment_status.wiki, "edit", return_value=True)
+    assert mark_deployment_status.save_planned_changes(
+        base_content, planned_changes, "summary"
+    )
+    assert edit.call_args.kwargs["text"] == latest_content.replace(
+        first, first.replace("status=", "status=done")
+    )
+
+
+def test_run_bulk_lookup_shares_change_details(mocker, capsys):
+    mocker.patch.dict(mark_deployment_status.change_details_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.change_status_cache, clear=True)
+    session = mocker.patch("mark_deployment_status.get_request_session")
+    session.return_value.get.return_value.status_code = 200
+    session.return_value.get.return_value.content = (
+        b')]}\'\n{"status": "MERGED", "subject": "Add Atieno\'s public key"}'
+    )
+    mocker.patch("mark_deployment_status.did_change_get_deployed", return_value=False)
+    mark_deployment_status.run_bulk_lookup(
+        mark_deployment_status.read_change_ids(["1101577", "1101577"]),
+        mark_deployment_status.lookup_deployment_status,
+        mark_deployment_status.format_deployment_status,
+        "json",
+    )
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert mark_deployment_status.json.loads(lines[0]) == {
+        "id": "1101577",
+        "title": "Add Atieno's public key",
+        "status": "MERGED",
+        "deployer": None,
+        "deployed_on": None,
+        "sal": None,
+    }
+    # The title and status come from a single Gerrit request
+    assert session.return_value.get.call_count == 1
+
+
+def test_apply_duplicate_policy():
+    newest = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=1|title=Again|status=}}"
+    )
+    unique = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=2|title=Unique|status=}}"
+    )
+    oldest = mark_deployment_status.Backports.Deployment(
+        "{{deploy|type=config|gerrit=1|title=First try|status=}}"
+    )
+    candidates = [newest, unique, oldest]
+    assert mark_deployment_status.apply_duplicate_policy(candidates, "all") == [
+        newest,
+        unique,
+        oldest,
+    ]
+    assert mark_deployment_status.apply_duplicate_policy(candidates, "newest") == [
+        newest,
+        unique,
+    ]
+    assert mark_deployment_status.apply_duplicate_policy(candidates, "flag") == [unique]
+
+
+def test_check_deployments_isolates_failures(mocker, tmp_path, run_check_deployments):
+    failed_ids_file = tmp_path / "failed_gerrit_ids.json"
+    # 1 is resolved now, 3 is on the page but not in this run's events, and 111
+    # isn't on the page any more
+    failed_ids_file.write_text('["1", "111", "3"]')
+
+    def get_change_details(change_id):
+        if change_id == "2":
+            raise mark_deployment_status.requests.ConnectionError("Gerrit is down")
+        return {"status": "ABANDONED"}
+
+    mocker.patch(
+        "mark_deployment_status.get_change_details", side_effect=get_change_details
+    )
+    working = "{{deploy|type=config|gerrit=1|title=Working|status=d}}"
+    failing = "{{deploy|type=config|gerrit=2|title=Failing|status=}}"
+    skipped = "{{deploy|type=config|gerrit=3|title=Skipped|status=}}"
+    page_content = f"== Monday ==\n{working}\n{failing}\n{skipped}\n"
+    # Only 1 and 2 came up in the Gerrit events
+    mark_deployment_status.queued_gerrit_ids.update({"1", "2"})
+    edit = run_check_deployments(page_content, events="events.json")
+    assert edit.call_args.kwargs["text"] == page_content.replace(
+        "status=d}}", "status=done}}"
+    )
+    assert mark_deployment_status.json.loads(failed_ids_file.read_text()) == [
+        "2",
+        "3",
+    ]
+
+
+def test_check_deployments_commits_when_failed_ids_cannot_be_recorded(
+    mocker, tmp_path, run_check_deployments
+):
+    mocker.patch.object(
+        mark_deployment_status.constants,
+        "FAILED_IDS_FILE",
+        str(tmp_path / "missing" / "failed_gerrit_ids.json"),
+    )
+    mocker.patch(
+        "mark_deployment_status.get_change_details",
+        return_value={"status": "ABANDONED"},
+    )
+    page_content = "== Monday ==\n{{deploy|type=config|gerrit=1|title=T|status=d}}\n"
+    edit = run_check_deployments(page_content)
+    edit.assert_called_once()
+
+
+def test_check_deployments_stops_when_time_budget_runs_out(
+    mocker, run_check_deployments
+):
+    # The deadline is set at 0s, the first item starts at 10s and the second at 100s
+    mocker.patch(
+        "mark_deployment_status.time.monotonic", side_effect=[0.0, 10.0, 100.0]
+    )
+    mocker.patch(
+        "mark_deployment_status.get_change_details",
+        return_value={"status": "ABANDONED"},
+    )
+    older = "{{deploy|type=config|gerrit=1|title=Older|status=nd}}"
+    newer = "{{deploy|type=config|gerrit=2|title=Newer|status=d}}"
+    page_content = f"== Monday ==\n{older}\n{newer}\n"
+    edit = run_check_deployments(page_content, time_budget=90.0)
+    # Only the most recent item was resolved before the budget ran out
+    edit.assert_called_once()
+    assert edit.call_args.kwargs["text"] == page_content.replace(
+        "status=d}}", "status=done}}"
+    )
+
+
+def test_save_planned_changes_page_gone(mocker):
+    deployment = "{{deploy|type=config|gerrit=1|title=First|status=}}"
+    base_content = f"== Monday ==\n{deployment}\n"
+    planned_changes = mark_deployment_status.plan_page_changes(
+        base_content, {deployment: deployment.replace("status=", "status=done")}
+    )
+    mocker.patch.object(mark_deployment_status.wiki, "page_text", return_value=None)
+    edit = mocker.patch.object(mark_deployment_status.wiki, "edit")
+    assert not mark_deployment_status.save_planned_changes(
+        base_content, planned_changes, "summary"
+    )
+    edit.assert_not_called()
+
+
+def test_lookup_deployment_status_not_found(mocker):
+    mocker.patch.dict(mark_deployment_status.change_details_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.change_status_cache, clear=True)
+    session = mocker.patch("mark_deployment_status.get_request_session")
+    session.return_value.get.return_value.status_code = 404
+    assert mark_deployment_status.lookup_deployment_status("1101577")["title"] is None
+    # The title and status lookups share the one "not found" response
+    assert session.return_value.get.call_count == 1
+
+
+def test_apply_duplicate_policy_flag_logs_once(mocker):
+    mocker.patch.object(
+        mark_deployment_status,
+        "args",
+        mark_deployment_status.argparse.Namespace(
+            **{**vars(mark_deployment_status.args), "log_to_wiki": True}
+        ),
+    )
+    log_to_wiki = mocker.patch("mark_deployment_status.log_to_wiki")
+    candidates = [
+        mark_deployment_status.Backports.Deployment(
+            f"{{{{deploy|type=config|gerrit={gerrit_id}|title=Title|status=}}}}"
+        )
+        for gerrit_id in ["1", "2", "1", "2"]
+    ]
+    assert mark_deployment_status.apply_duplicate_policy(candidates, "flag") == []
+    log_to_wiki.assert_called_once()
+
+
+@pytest.mark.parametrize("duplicates", ["all", "newest"])
+def test_check_deployments_duplicates(mocker, run_check_deployments, duplicates):
+    def get_from_host(session, host, url):
+        response = mocker.Mock()
+        if url.endswith("/2"):
+            response.status_code = 404
+        else:
+            response.status_code = 200
+            response.content = b')]}\'\n{"status": "ABANDONED", "subject": "x"}'
+        return response
+
+    get_from_host = mocker.patch(
+        "mark_deployment_status.get_from_host", side_effect=get_from_host
+    )
+    valid = "{{deploy|type=config|gerrit=1|title=Valid|status=d}}"
+    # The newest entry for change 1 is missing its title
+    page_content = (
+        f"== Monday ==\n{valid}\n"
+        "{{deploy|type=config|gerrit=2|title=Missing|status=}}\n"
+        "== Tuesday ==\n{{deploy|type=config|gerrit=1|status=}}\n"
+        "{{deploy|type=config|gerrit=2|title=Missing again|status=}}\n"
+    )
+    edit = run_check_deployments(page_content, duplicates=duplicates)
+    assert edit.call_args.kwargs["text"] == page_content.replace(
+        valid, valid.replace("status=d}}", "status=done}}")
+    )
+    # One Gerrit request per change, even for the one Gerrit can't find
+    assert get_from_host.call_count == 2
+
+
+@pytest.mark.parametrize("status_code", [403, 429])
+def test_get_change_details_does_not_cache_transient_errors(mocker, status_code):
+    mocker.patch.dict(mark_deployment_status.change_details_cache, clear=True)
+    mocker.patch.dict(mark_deployment_status.circuit_breakers, clear=True)
+    session = mocker.patch("mark_deployment_status.get_request_session")
+    session.return_value.get.return_value.status_code = status_code
+    with pytest.raises(mark_deployment_status.requests.HTTPError):
+        mark_deployment_status.get_change_details("1101577")
+    assert "1101577" not in mark_deployment_status.change_details_cache
+    breaker = mark_deployment_status.circuit_breakers[
+        mark_deployment_status.constants.GERRIT_URL
+    ]
+    assert breaker.failures == (1 if status_code == 429 else 0)
+
+
+def test_check_deployments_lets_bugs_propagate(mocker, run_check_deployments):
+    mocker.patch(
+        "mark_deployment_status.get_change_details", side_effect=KeyError("status")
+    )
+    with pytest.raises(KeyError):
+        run_check_deployments(
+            "== Monday ==\n{{deploy|type=config|gerrit=1|title=T|status=}}\n"
+        )
+
+
+def test_check_deployments_stops_when_gerrit_is_down(
+    mocker, tmp_path, run_check_deployments
+):
+    session = mocker.patch("mark_deployment_status.get_request_session")
+    session.return_value.get.side_effect = (
+        mark_deployment_status.requests.ConnectionError("Gerrit is down")
+    )
+    page_content = "== Monday ==\n" + "".join(
+        f"{{{{deploy|type=config|gerrit={gerrit_id}|title=T|status=}}}}\n"
+        for gerrit_id in range(1, 21)
+    )
+    edit = run_check_deployments(page_content)
+    edit.assert_not_called()
+    threshold = mark_deployment_status.constants.CIRCUIT_BREAKER_THRESHOLD
+    assert session.return_value.get.call_count == threshold
+    assert mark_deployment_status.time.sleep.call_count == threshold
+    # Only the deployments that were actually attempted are recorded, newest first
+    assert mark_deployment_status.json.loads(
+        (tmp_path / "failed_gerrit_ids.json").read_text()
+    ) == sorted(str(gerrit_id) for gerrit_id in range(21 - threshold, 21))
+
+
+def test_check_deployments_retries_stop_at_deadline(mocker, run_check_deployments):
+    # Deadline set, two first attempts, the first retry round starts, one retry
+    # goes out, then the budget runs out for the second retry and the next round
+    mocker.patch(
+        "mark_deployment_status.time.monotonic",
+        side_effect=[0.0, 1.0, 2.0, 3.0, 4.0, 100.0, 100.0],
+    )
+    get_change_details = mocker.patch(
+        "mark_deployment_status.get_change_details",
+        side_effect=mark_deployment_status.requests.ConnectionError("Gerrit is slow"),
+    )
+    run_check_deployments(
+        "== Monday ==\n{{deploy|type=config|gerrit=1|title=T|status=}}\n"
+        "{{deploy|type=config|gerrit=2|title=T|status=}}\n",
+        time_budget=90.0,
+    )
+    assert get_change_details.call_count == 3
+
+
+def test_ingest_gerrit_events_stops_on_a_continuous_stream(mocker):
+    mocker.patch.object(mark_deployment_status, "queued_gerrit_ids", set())
+    mocker.patch.dict(mark_deployment_status.change_status_cache, clear=True)
+    server = mark_deployment_status.socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+
+    def stream_events():
+        connection, _ = server.accept()
+        with connection:
+            for number in range(1, 6):
+                connection.sendall(
+                    f'{{"type": "change-merged", "change": {{"number": {number}}}}}\n'.encode()
+                )
+            # Keep the stream open, like `gerrit stream-events` does
+            connection.recv(1)
+
+    mark_deployment_status.threading.Thread(target=stream_events, daemon=True).start()
+    source = f"tcp://127.0.0.1:{port}"
+    assert mark_deployment_status.ingest_gerrit_events(source, 60, max_events=3) == 3
+    assert mark_deployment_status.ingest_gerrit_events(source, 0.5) == 0
+    server.close()